@@ -1,23 +1,140 @@
 import os
 import sqlite3
-from datetime import date, timedelta
-from functools import wraps
+import threading
+import time
+from collections import defaultdict
+from datetime import date
+from functools import lru_cache, wraps
 from pathlib import Path
 
 from werkzeug.security import check_password_hash, generate_password_hash
-from flask import Flask, flash, render_template, request, redirect, session, url_for
+from flask import Flask, flash, g, render_template, request, redirect, session, url_for
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-change-me")
 DB_PATH = Path(__file__).parent / "habittracker.db"
-
-STICKERS = ["🌸", "⭐", "💻", "📚", "🌙", "☕", "🎀", "✨"]
+SCHEMA_VERSION = 1
+
+STICKERS = ("🌸", "⭐", "💻", "📚", "🌙", "☕", "🎀", "✨")
+app.jinja_env.globals["stickers"] = STICKERS
+
+# Rendered star ratings, indexed by the number of filled stars (0-5)
+_STARS = tuple("★" * i + "☆" * (5 - i) for i in range(6))
+
+# Statements run on every dashboard load or entry post
+SQL_ADD_ENTRY = (
+    "INSERT INTO habit_entries (user_id, habit_id, entry_date, hours, note, sticker) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+SQL_HABIT_TOTALS = """
+    SELECT h.id, h.name, COALESCE(SUM(e.hours), 0) AS total
+    FROM habits h
+    LEFT JOIN habit_entries e
+        ON e.habit_id = h.id AND e.user_id = h.user_id AND e.entry_date = ?
+    WHERE h.user_id = ?
+    GROUP BY h.id
+    ORDER BY h.name
+"""
+SQL_ALL_TODAY_ENTRIES = (
+    "SELECT * FROM habit_entries WHERE user_id = ? AND entry_date = ? ORDER BY habit_id, id"
+)
+# Walks back one day at a time from today and stops at the first day without entries
+SQL_STREAK = """
+    WITH RECURSIVE d(day) AS (
+        SELECT :today
+        UNION ALL
+        SELECT date(day, '-1 day') FROM d
+        WHERE EXISTS (SELECT 1 FROM habit_entries WHERE user_id = :user_id AND entry_date = d.day)
+    )
+    SELECT COUNT(*) FROM d
+    WHERE EXISTS (SELECT 1 FROM habit_entries WHERE user_id = :user_id AND entry_date = d.day)
+"""
+
+# journal_mode=WAL is stored in the database file, so it only needs setting once
+# per process; the remaining pragmas are per-connection and run on every open.
+_wal_enabled = False
+
+
+def _apply_pragmas(conn):
+    global _wal_enabled
+    if not _wal_enabled:
+        conn.execute("PRAGMA journal_mode=WAL")
+        _wal_enabled = True
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("PRAGMA mmap_size=268435456")
+    if sqlite3.sqlite_version_info < (3, 46, 0):
+        # Older SQLite has no built-in limit on the ANALYZE run by PRAGMA optimize
+        conn.execute("PRAGMA analysis_limit=400")
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    _apply_pragmas(conn)
+    return conn
 
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # One connection per app context, closed by close_db() on teardown
+    if "db" not in g:
+        g.db = _connect()
+    return g.db
+
+
+@app.teardown_appcontext
+def close_db(exception=None):
+    conn = g.pop("db", None)
+    if conn is not None:
+        try:
+            # Let SQLite refresh planner statistics for tables this connection used
+            conn.execute("PRAGMA optimize")
+        except sqlite3.OperationalError:
+            # Statistics are best-effort; a busy database must not fail the request
+            pass
+        finally:
+            conn.close()
+
+
+# Rewards are shared by all users and only change through the dashboard's reward
+# actions. This process's own writes bump the version and invalidate at once;
+# the TTL bounds how long writes made by other worker processes stay unseen.
+REWARDS_CACHE_TTL = 5.0
+_rewards_lock = threading.Lock()
+_rewards_version = 0
+_rewards_cache = None
+
+
+def invalidate_rewards():
+    global _rewards_version
+    with _rewards_lock:
+        _rewards_version += 1
+
+
+def get_rewards(conn):
+    global _rewards_cache
+    with _rewards_lock:
+        version = _rewards_version
+        now = time.monotonic()
+        if _rewards_cache is not None:
+            cached_version, fetched_at, rewards = _rewards_cache
+            if cached_version == version and now - fetched_at < REWARDS_CACHE_TTL:
+                return rewards
+    rewards = tuple(conn.execute("SELECT * FROM rewards ORDER BY unlocked, id"))
+    with _rewards_lock:
+        # Tagged with the version read before the query, so a write that lands
+        # in between leaves this entry stale and forces the next refetch
+        _rewards_cache = (version, now, rewards)
+    return rewards
+
+
+@app.before_request
+def set_today():
+    # Resolve the date once so every query in a request agrees on "today"
+    g.today = date.today().isoformat()
 
 
 def login_required(view):
@@ -30,6 +147,7 @@ def login_required(view):
 
 
 @app.template_filter("float_format")
+@lru_cache(maxsize=128)
 def float_format(value):
     try:
         return f"{float(value):.1f}"
@@ -38,13 +156,74 @@ def float_format(value):
 @app.template_filter("stars")
 def stars_filter(value):
     try:
-        return "★" * int(value) + "☆" * (5 - int(value))
+        return _STARS[max(0, min(5, int(value)))]
     except (ValueError, TypeError):
         return ""
 
 
+def _migrate(conn):
+    # Ensure multi-user columns exist for databases created before user support
+    for table in ("habits", "habit_entries"):
+        columns = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        if not any(col["name"] == "user_id" for col in columns):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN user_id INTEGER")
+
+    # SQLite cannot alter a foreign key, so rebuild habit_entries unless deleting a
+    # habit already cascades to its entries (including when there is no FK at all)
+    habit_fk = [
+        fk for fk in conn.execute("PRAGMA foreign_key_list(habit_entries)").fetchall()
+        if fk["table"] == "habits"
+    ]
+    if not any(fk["on_delete"] == "CASCADE" for fk in habit_fk):
+        # Keep user_id nullable where the ALTER above added it, since rows logged
+        # before user support have no owner
+        user_id_notnull = any(
+            col["name"] == "user_id" and col["notnull"]
+            for col in conn.execute("PRAGMA table_info(habit_entries)").fetchall()
+        )
+        user_id_type = "INTEGER NOT NULL" if user_id_notnull else "INTEGER"
+        conn.execute(f"""
+            CREATE TABLE habit_entries_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id {user_id_type},
+                habit_id INTEGER NOT NULL,
+                entry_date DATE NOT NULL,
+                hours REAL NOT NULL,
+                note TEXT,
+                sticker TEXT,
+                FOREIGN KEY (habit_id) REFERENCES habits(id) ON DELETE CASCADE,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        """)
+        conn.execute("""
+            INSERT INTO habit_entries_new (id, user_id, habit_id, entry_date, hours, note, sticker)
+                SELECT id, user_id, habit_id, entry_date, hours, note, sticker FROM habit_entries
+        """)
+        conn.execute("DROP TABLE habit_entries")
+        conn.execute("ALTER TABLE habit_entries_new RENAME TO habit_entries")
+
+    # reflections(user_id, entry_date) and current habits tables are covered by
+    # their UNIQUE constraints; habits created before user support only carry
+    # UNIQUE(name), so index (user_id, name) there
+    habits_unique_columns = [
+        [col["name"] for col in conn.execute(f"PRAGMA index_info({idx['name']})").fetchall()]
+        for idx in conn.execute("PRAGMA index_list(habits)").fetchall()
+        if idx["unique"]
+    ]
+    if ["user_id", "name"] not in habits_unique_columns:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_habits_user_name ON habits (user_id, name)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_entries_user_date ON habit_entries (user_id, entry_date)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_entries_habit_user_date "
+        "ON habit_entries (habit_id, user_id, entry_date)"
+    )
+    conn.execute("ANALYZE")
+
+
 def init_db():
-    conn = get_db()
+    conn = _connect()
     conn.executescript("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -69,7 +248,7 @@ def init_db():
             hours REAL NOT NULL,
             note TEXT,
             sticker TEXT,
-            FOREIGN KEY (habit_id) REFERENCES habits(id),
+            FOREIGN KEY (habit_id) REFERENCES habits(id) ON DELETE CASCADE,
             FOREIGN KEY (user_id) REFERENCES users(id)
         );
 
@@ -100,13 +279,25 @@ def init_db():
             review TEXT
         );
     """)
-    # Ensure multi-user columns exist for databases created before user support
-    for table in ("habits", "habit_entries"):
-        columns = conn.execute(f"PRAGMA table_info({table})").fetchall()
-        if not any(col["name"] == "user_id" for col in columns):
-            conn.execute(f"ALTER TABLE {table} ADD COLUMN user_id INTEGER")
+    # Migrations below only need to run once per database file; user_version
+    # records which schema the file has already been brought up to. The whole
+    # migration holds the write lock, so workers starting together apply it once,
+    # and foreign keys stay off while habit_entries may be rebuilt.
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            _migrate(conn)
+            conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
 
     conn.commit()
+    conn.execute("PRAGMA optimize=0x10002")
     conn.close()
 
 
@@ -138,12 +329,9 @@ def signup():
             conn.commit()
             user_id = cur.lastrowid
         except sqlite3.IntegrityError:
-            conn.close()
             flash("Username already exists.")
             return render_template("signup.html")
 
-        conn.close()
-
         session["user_id"] = user_id
         session["username"] = username
         return redirect(url_for("dashboard"))
@@ -159,9 +347,8 @@ def login():
 
         conn = get_db()
         user = conn.execute(
-            "SELECT * FROM users WHERE username = ?", (username,)
+            "SELECT id, password_hash FROM users WHERE username = ?", (username,)
         ).fetchone()
-        conn.close()
 
         if not user:
             flash("No account found with that username. You can sign up to create one.")
@@ -172,7 +359,7 @@ def login():
             return render_template("login.html")
 
         session["user_id"] = user["id"]
-        session["username"] = user["username"]
+        session["username"] = username
         return redirect(url_for("dashboard"))
 
     return render_template("login.html")
@@ -189,95 +376,80 @@ def logout():
 @app.route("/dashboard", methods=["GET", "POST"])
 @login_required
 def dashboard():
-    today = date.today().isoformat()
+    today = g.today
     user_id = session["user_id"]
     conn = get_db()
 
     if request.method == "POST":
         action = request.form.get("action")
 
-        if action == "add_habit":
-            name = request.form.get("habit_name", "").strip()
-            if name:
-                try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if action == "add_habit":
+                name = request.form.get("habit_name", "").strip()
+                if name:
+                    try:
+                        conn.execute(
+                            "INSERT INTO habits (user_id, name) VALUES (?, ?)",
+                            (user_id, name),
+                        )
+                    except sqlite3.IntegrityError:
+                        pass
+
+            elif action == "delete_habit":
+                habit_id = request.form.get("habit_id", type=int)
+                if habit_id:
                     conn.execute(
-                        "INSERT INTO habits (user_id, name) VALUES (?, ?)",
-                        (user_id, name),
+                        "DELETE FROM habits WHERE id = ? AND user_id = ?",
+                        (habit_id, user_id),
                     )
-                except sqlite3.IntegrityError:
-                    pass
 
-        elif action == "delete_habit":
-            habit_id = request.form.get("habit_id", type=int)
-            if habit_id:
-                conn.execute(
-                    "DELETE FROM habit_entries WHERE habit_id = ? AND user_id = ?",
-                    (habit_id, user_id),
-                )
+            elif action == "add_entry":
+                habit_id = request.form.get("habit_id", type=int)
+                hours = request.form.get("hours", type=float)
+                note = request.form.get("note", "")
+                sticker = request.form.get("sticker")
+                if habit_id and hours:
+                    try:
+                        conn.execute(
+                            SQL_ADD_ENTRY,
+                            (user_id, habit_id, today, hours, note, sticker),
+                        )
+                    except sqlite3.IntegrityError:
+                        pass
+
+            elif action == "add_reward":
+                name = request.form.get("reward_name")
+                req_type = request.form.get("requirement_type")
+                req_value = request.form.get("requirement_value", type=int)
                 conn.execute(
-                    "DELETE FROM habits WHERE id = ? AND user_id = ?",
-                    (habit_id, user_id),
+                    "INSERT INTO rewards (name, requirement_type, requirement_value) VALUES (?, ?, ?)",
+                    (name, req_type, req_value),
                 )
 
-        elif action == "add_entry":
-            habit_id = request.form.get("habit_id", type=int)
-            hours = request.form.get("hours", type=float)
-            note = request.form.get("note", "")
-            sticker = request.form.get("sticker")
-            if habit_id and hours:
-                conn.execute(
-                    "INSERT INTO habit_entries (user_id, habit_id, entry_date, hours, note, sticker) VALUES (?, ?, ?, ?, ?, ?)",
-                    (user_id, habit_id, today, hours, note, sticker),
-                )
+            elif action == "unlock_reward":
+                reward_id = request.form.get("reward_id", type=int)
+                conn.execute("UPDATE rewards SET unlocked = 1 WHERE id = ?", (reward_id,))
 
-        elif action == "add_reward":
-            name = request.form.get("reward_name")
-            req_type = request.form.get("requirement_type")
-            req_value = request.form.get("requirement_value", type=int)
-            conn.execute(
-                "INSERT INTO rewards (name, requirement_type, requirement_value) VALUES (?, ?, ?)",
-                (name, req_type, req_value),
-            )
+            elif action == "delete_reward":
+                reward_id = request.form.get("reward_id", type=int)
+                conn.execute("DELETE FROM rewards WHERE id = ?", (reward_id,))
 
-        elif action == "unlock_reward":
-            reward_id = request.form.get("reward_id", type=int)
-            conn.execute("UPDATE rewards SET unlocked = 1 WHERE id = ?", (reward_id,))
+        if action in ("add_reward", "unlock_reward", "delete_reward"):
+            invalidate_rewards()
 
-        elif action == "delete_reward":
-            reward_id = request.form.get("reward_id", type=int)
-            conn.execute("DELETE FROM rewards WHERE id = ?", (reward_id,))
+    habits = conn.execute(SQL_HABIT_TOTALS, (today, user_id)).fetchall()
 
-        conn.commit()
+    entries_by_habit = defaultdict(list)
+    for entry in conn.execute(SQL_ALL_TODAY_ENTRIES, (user_id, today)):
+        entries_by_habit[entry["habit_id"]].append(entry)
 
-    habits = conn.execute(
-        "SELECT * FROM habits WHERE user_id = ? ORDER BY name",
-        (user_id,),
-    ).fetchall()
-
-    habit_data = []
-    total_hours = 0
-
-    for habit in habits:
-        entries = conn.execute(
-            "SELECT * FROM habit_entries WHERE habit_id = ? AND user_id = ? AND entry_date = ?",
-            (habit["id"], user_id, today),
-        ).fetchall()
-        habit_total = sum(e["hours"] for e in entries)
-        total_hours += habit_total
-        habit_data.append({"habit": habit, "entries": entries, "total": habit_total})
-
-    streak = 0
-    check_date = date.today()
-    while True:
-        row = conn.execute(
-            "SELECT 1 FROM habit_entries WHERE user_id = ? AND entry_date = ? LIMIT 1",
-            (user_id, check_date.isoformat()),
-        ).fetchone()
-        if row:
-            streak += 1
-            check_date -= timedelta(days=1)
-        else:
-            break
+    habit_data = [
+        (habit, entries_by_habit[habit["id"]], habit["total"]) for habit in habits
+    ]
+    total_hours = sum(habit["total"] for habit in habits)
+
+    streak = conn.execute(SQL_STREAK, {"today": today, "user_id": user_id}).fetchone()[0]
 
     today_reflection = conn.execute(
         "SELECT mood FROM reflections WHERE user_id = ? AND entry_date = ?",
@@ -286,9 +458,7 @@ def dashboard():
 
     today_mood = today_reflection["mood"] if today_reflection else None
 
-    rewards = conn.execute("SELECT * FROM rewards ORDER BY unlocked, id").fetchall()
-
-    conn.close()
+    rewards = get_rewards(conn)
 
     return render_template(
         "dashboard.html",
@@ -297,7 +467,6 @@ def dashboard():
         total_hours=total_hours,
         streak=streak,
         today_mood=today_mood,
-        stickers=STICKERS,
         rewards=rewards,
     )
 # ---------------- REFLECTION ---------------- #
@@ -305,7 +474,7 @@ def dashboard():
 @app.route("/reflection", methods=["GET", "POST"])
 @login_required
 def reflection():
-    today = date.today().isoformat()
+    today = g.today
     conn = get_db()
     
     if request.method == "POST":
@@ -314,16 +483,17 @@ def reflection():
         improvement = request.form.get("improvement")
         mood = request.form.get("mood")
         
-        conn.execute("""
-            INSERT INTO reflections (user_id, entry_date, reflection_text, win, improvement, mood)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(user_id, entry_date) DO UPDATE SET
-                reflection_text=excluded.reflection_text,
-                win=excluded.win,
-                improvement=excluded.improvement,
-                mood=excluded.mood
-        """, (session["user_id"], today, reflection_text, win, improvement, mood))
-        conn.commit()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                INSERT INTO reflections (user_id, entry_date, reflection_text, win, improvement, mood)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, entry_date) DO UPDATE SET
+                    reflection_text=excluded.reflection_text,
+                    win=excluded.win,
+                    improvement=excluded.improvement,
+                    mood=excluded.mood
+            """, (session["user_id"], today, reflection_text, win, improvement, mood))
         flash("Reflection saved!")
         return redirect(url_for("dashboard"))
 
@@ -331,7 +501,6 @@ def reflection():
         "SELECT * FROM reflections WHERE user_id = ? AND entry_date = ?",
         (session["user_id"], today)
     ).fetchone()
-    conn.close()
     
     return render_template("reflection.html", reflection=reflection, entry_date=today)
 # ---------------- BOOKS & MOVIES ---------------- #
@@ -344,27 +513,30 @@ def books_movies():
     if request.method == "POST":
         action = request.form.get("action")
         
-        if action == "add_media":
-            title = request.form.get("title")
-            media_type = request.form.get("type")
-            rating = request.form.get("rating")
-            review = request.form.get("review")
-            conn.execute(
-                "INSERT INTO media (title, type, rating, review) VALUES (?, ?, ?, ?)",
-                (title, media_type, rating, review)
-            )
-            
-        elif action == "delete_media":
-            media_id = request.form.get("media_id")
-            conn.execute("DELETE FROM media WHERE id = ?", (media_id,))
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if action == "add_media":
+                title = request.form.get("title")
+                media_type = request.form.get("type")
+                rating = request.form.get("rating")
+                review = request.form.get("review")
+                conn.execute(
+                    "INSERT INTO media (title, type, rating, review) VALUES (?, ?, ?, ?)",
+                    (title, media_type, rating, review)
+                )
             
-        conn.commit()
+            elif action == "delete_media":
+                media_id = request.form.get("media_id")
+                conn.execute("DELETE FROM media WHERE id = ?", (media_id,))
+
         return redirect(url_for("books_movies"))
 
     # Fetching the data to show on the page
     entries = conn.execute("SELECT * FROM media ORDER BY id DESC").fetchall()
-    conn.close()
     return render_template("books_movies.html", entries=entries)
+# Create and migrate the schema on import so WSGI servers such as gunicorn, which
+# never run the __main__ block, serve a database with the cascade and indexes
+init_db()
+
 if __name__ == "__main__":
-    init_db()
     app.run(debug=True)
\ No newline at end of file